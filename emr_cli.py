@@ -2,14 +2,51 @@
 """Lightweight EMR CLI: manage patient records using CSV."""
 
 import argparse
+import atexit
+import bisect
+import contextlib
 import csv
+import io
+import itertools
 import json
 import logging
+import logging.handlers
+import mmap
 import os
+import re
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # fcntl is POSIX-only; appends go unlocked elsewhere
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; stats on fresh columns falls back to pure Python
+    np = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; export falls back to the json module
+    orjson = None
+
+try:
+    import hyperscan
+except ImportError:  # hyperscan is optional; search-batch falls back to re
+    hyperscan = None
 
 CSV_FILE = os.path.join(os.path.dirname(__file__), "patients.csv")
+COLUMNS_FILE = CSV_FILE + ".columns.json"
+ID_FILE = CSV_FILE + ".nextid"
+OFFSETS_FILE = CSV_FILE + ".offsets"
+IDS_FILE = CSV_FILE + ".ids.bin"
+ROW_OFFSETS_FILE = CSV_FILE + ".offsets.bin"
+ZONEMAP_FILE = CSV_FILE + ".zonemap.json"
 LOG_FILE = os.path.join(os.path.dirname(__file__), "emr.log")
 FIELDNAMES = [
     "id",
@@ -22,159 +59,868 @@ FIELDNAMES = [
     "notes",
     "created_at",
     "updated_at",
+    "name_lower",
+    "phone_digits",
 ]
-
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-)
+(
+    IDX_ID,
+    IDX_NAME,
+    IDX_AGE,
+    IDX_GENDER,
+    IDX_PHONE,
+    IDX_MEDS,
+    IDX_APPOINTMENTS,
+    IDX_NOTES,
+    IDX_CREATED_AT,
+    IDX_UPDATED_AT,
+    IDX_NAME_LOWER,
+    IDX_PHONE_DIGITS,
+) = range(len(FIELDNAMES))
+# Fields of journals written before name_lower and phone_digits were stored;
+# their rows are a prefix of the current ones.
+LEGACY_FIELD_COUNT = IDX_NAME_LOWER
+# A patient record as a list of field values in FIELDNAMES order.
+Row = List[str]
+# Live ids in ascending order (array "I") and, at the same positions, the byte
+# offsets of their latest journal rows (array "Q").
+OffsetMap = Tuple[array, array]
+# Sentinel stored in ``notes`` to mark a deleted record in the journal.
+TOMBSTONE = "__tombstone__"
+# Minimum number of stale rows before ``compact`` rewrites the journal.
+COMPACT_THRESHOLD = 1000
+# Appended bytes scanned on top of a sidecar that covers a prefix of the
+# journal before the sidecar is rebuilt.
+SIDECAR_MAX_TAIL = 1 << 20
+# Rows per zonemap chunk of the journal.
+CHUNK_ROWS = 10_000
+# Live rows needed (in more than two chunks) before scans run in parallel.
+PARALLEL_MIN_ROWS = 100_000
+# Worker processes for parallel scans; with one CPU they scan serially.
+PARALLEL_WORKERS = os.cpu_count() or 1
+# Buffer size for bulk writers, so large files go out in few write() calls.
+WRITE_BUFFER = 1 << 20
+
+# Folded journal of the last read_journal call, reused while the CSV's
+# (path, mtime_ns, size) is unchanged.
+_JOURNAL_CACHE: Dict[str, Any] = {}
+
+# Fields ``update`` can set: (argument name, row index, set when merely not
+# None). Fields with the flag off are only set when the argument is truthy.
+_UPDATE_FIELDS: List[Tuple[str, int, bool]] = [
+    ("name", IDX_NAME, False),
+    ("age", IDX_AGE, True),
+    ("gender", IDX_GENDER, False),
+    ("phone", IDX_PHONE, False),
+    ("meds", IDX_MEDS, True),
+    ("appointments", IDX_APPOINTMENTS, True),
+    ("notes", IDX_NOTES, True),
+]
+# Everything but ASCII digits, stripped to normalise phone numbers.
+_NON_DIGITS = re.compile(r"[^0-9]")
+# Queries that look like a phone number: digits plus common separators.
+_PHONE_QUERY = re.compile(r"[0-9()+. -]*[0-9][0-9()+. -]*")
+# Reused buffer and writer that format one row into a CSV line for appends.
+_LINE_BUFFER = io.StringIO()
+_LINE_WRITER = csv.writer(_LINE_BUFFER)
+# Generated field updaters, keyed by the bitmask of the fields they set.
+_UPDATERS: Dict[int, Callable[[Row, argparse.Namespace, str], None]] = {}
+
+# Log records are buffered in memory and written out in one go at exit (or
+# when the buffer fills, or on an error), instead of one write per record.
+_LOG_FILE_HANDLER = logging.FileHandler(LOG_FILE, encoding="utf-8")
+_LOG_FILE_HANDLER.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_LOG_BUFFER = logging.handlers.MemoryHandler(capacity=1024, target=_LOG_FILE_HANDLER)
+logging.basicConfig(level=logging.INFO, handlers=[_LOG_BUFFER])
+atexit.register(_LOG_BUFFER.flush)
 
 
 def ensure_csv() -> None:
     """Create CSV file with headers if it doesn't exist."""
     if not os.path.exists(CSV_FILE):
         with open(CSV_FILE, "w", newline="", encoding="utf-8") as file_handle:
-            writer = csv.DictWriter(file_handle, fieldnames=FIELDNAMES)
-            writer.writeheader()
+            csv.writer(file_handle).writerow(FIELDNAMES)
 
 
-def read_all() -> List[Dict[str, str]]:
-    """Read all patient records from CSV."""
+@contextlib.contextmanager
+def open_journal() -> Iterator[Any]:
+    """Open the CSV journal for scanning, memory-mapped unless it is empty."""
     ensure_csv()
-    with open(CSV_FILE, newline="", encoding="utf-8") as file_handle:
-        return list(csv.DictReader(file_handle))
+    with open(CSV_FILE, "rb") as file_handle:
+        if os.fstat(file_handle.fileno()).st_size == 0:
+            yield file_handle
+            return
+        with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as journal:
+            yield journal
+
+
+def read_journal() -> Tuple[Dict[str, Row], int]:
+    """Fold the append-only CSV journal into the latest version of each record."""
+    ensure_csv()
+    key = (CSV_FILE, *csv_signature())
+    if _JOURNAL_CACHE.get("key") == key:
+        return _JOURNAL_CACHE["latest"], _JOURNAL_CACHE["physical"]
+    latest: Dict[str, Row] = {}
+    physical = 0
+    with open_journal() as journal:
+        reader = csv.reader(line.decode("utf-8") for line in iter(journal.readline, b""))
+        next(reader, None)
+        for row in reader:
+            if not row:  # a blank line holds no record
+                continue
+            physical += 1
+            if row[IDX_NOTES] == TOMBSTONE:
+                latest.pop(row[IDX_ID], None)
+            else:
+                latest[row[IDX_ID]] = upgrade_row(row)
+    _JOURNAL_CACHE.update(key=key, latest=latest, physical=physical)
+    return latest, physical
+
+
+def read_all() -> List[Row]:
+    """Read all live patient records from CSV."""
+    latest, _physical = read_journal()
+    return list(latest.values())
+
+
+def format_row(row: Row) -> bytes:
+    """Return ``row`` as one encoded CSV line, quoted like csv.writer does."""
+    _LINE_BUFFER.seek(0)
+    _LINE_BUFFER.truncate()
+    _LINE_WRITER.writerow(row)
+    return _LINE_BUFFER.getvalue().encode("utf-8")
+
+
+@contextlib.contextmanager
+def locked_journal() -> Iterator[BinaryIO]:
+    """Open the CSV journal for unbuffered appends, locked until the block exits."""
+    _JOURNAL_CACHE.clear()
+    ensure_csv()
+    while True:
+        file_handle = open(CSV_FILE, "ab", buffering=0)  # pylint: disable=consider-using-with
+        if fcntl is None:
+            break
+        fcntl.flock(file_handle, fcntl.LOCK_EX)
+        # A compact that held the lock may have replaced the file meanwhile.
+        if os.fstat(file_handle.fileno()).st_ino == os.stat(CSV_FILE).st_ino:
+            break
+        file_handle.close()
+    with file_handle:
+        yield file_handle
 
 
-def write_all(rows: List[Dict[str, str]]) -> None:
-    """Write all patient records to CSV."""
-    with open(CSV_FILE, "w", newline="", encoding="utf-8") as file_handle:
-        writer = csv.DictWriter(file_handle, fieldnames=FIELDNAMES)
-        writer.writeheader()
+@contextlib.contextmanager
+def atomic_open(path: str, mode: str = "w", **kwargs: Any) -> Iterator[Any]:
+    """Write to a private temp file next to ``path`` that replaces it when the block exits."""
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory or None)
+    try:
+        with open(fd, mode, **kwargs) as file_handle:
+            yield file_handle
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def write_all(rows: List[Row]) -> None:
+    """Write all patient records to CSV, sorted by id; callers hold ``locked_journal()``."""
+    rows = sorted(rows, key=lambda row: int(row[IDX_ID]))
+    _JOURNAL_CACHE.clear()
+    with atomic_open(CSV_FILE, newline="", encoding="utf-8", buffering=WRITE_BUFFER) as file_handle:
+        writer = csv.writer(file_handle)
+        writer.writerow(FIELDNAMES)
         writer.writerows(rows)
+    _write_columnar(rows, csv_signature())
+
+
+def csv_signature() -> List[int]:
+    """Return the CSV's (mtime_ns, size), used to detect stale sidecar files."""
+    stat = os.stat(CSV_FILE)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def journal_fingerprint(size: int) -> str:
+    """Return the last bytes before offset ``size`` of the CSV, hex encoded."""
+    with open(CSV_FILE, "rb") as file_handle:
+        file_handle.seek(max(0, size - 64))
+        return file_handle.read(size - file_handle.tell()).hex()
 
 
-def next_id(rows: List[Dict[str, str]]) -> str:
-    """Compute the next patient ID."""
-    if not rows:
-        return "1"
-    ids = [int(row["id"]) for row in rows if row["id"].isdigit()]
-    return str(max(ids) + 1)
+def write_sidecar(path: str, payload: Any) -> None:
+    """Atomically write a JSON sidecar file next to the CSV."""
+    with atomic_open(path, encoding="utf-8") as file_handle:
+        json.dump(payload, file_handle)
+
+
+def sidecar_header() -> Dict[str, Any]:
+    """Describe the journal as it is now, for sidecars that cover all of it."""
+    stat = os.stat(CSV_FILE)
+    return {
+        "signature": [stat.st_mtime_ns, stat.st_size],
+        "inode": stat.st_ino,
+        "fingerprint": journal_fingerprint(stat.st_size),
+    }
+
+
+def load_prefix_sidecar(path: str) -> Optional[Dict[str, Any]]:
+    """Load a sidecar written with ``sidecar_header`` if it still applies."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as file_handle:
+            sidecar = json.load(file_handle)
+        covered = sidecar["signature"][1]
+    except (ValueError, LookupError, TypeError):  # unreadable, so rebuild it
+        return None
+    stat = os.stat(CSV_FILE)
+    if (
+        sidecar.get("inode") == stat.st_ino
+        and covered <= stat.st_size
+        and sidecar.get("fingerprint") == journal_fingerprint(covered)
+    ):
+        return sidecar
+    return None
+
+
+def read_raw_record(file_handle: BinaryIO) -> bytes:
+    """Return the raw bytes of the CSV record at the current position of a binary handle."""
+    line = file_handle.readline()
+    while line.count(b'"') % 2:
+        more = file_handle.readline()
+        if not more:
+            break
+        line += more
+    return line
+
+
+def digits_only(text: str) -> str:
+    """Return the ASCII digits of ``text``, e.g. "98765" for "(987) 65"."""
+    return _NON_DIGITS.sub("", text)
+
+
+def phone_needle(query: str) -> Tuple[int, str]:
+    """Return the row field and needle for phone matches; phone-like queries match digits."""
+    if _PHONE_QUERY.fullmatch(query):
+        return IDX_PHONE_DIGITS, digits_only(query)
+    return IDX_PHONE, query
+
+
+def upgrade_row(row: Row) -> Row:
+    """Fill in ``name_lower`` and ``phone_digits`` for a row of a legacy journal."""
+    if len(row) == LEGACY_FIELD_COUNT:
+        row += [row[IDX_NAME].lower(), digits_only(row[IDX_PHONE])]
+    return row
+
+
+def parse_record(line: bytes) -> Optional[Row]:
+    """Parse the raw bytes of one CSV record into a row with all of FIELDNAMES, None if blank."""
+    row = next(csv.reader([line.decode("utf-8")]), [])
+    return upgrade_row(row) if row else None
+
+
+def read_record(file_handle: BinaryIO) -> Optional[Row]:
+    """Parse the CSV record at the current position of a binary handle, None at EOF or if blank."""
+    line = read_raw_record(file_handle)
+    return parse_record(line) if line else None
+
+
+def scan_offsets(file_handle: BinaryIO, start: int = 0) -> Dict[int, int]:
+    """Map each id seen from byte ``start`` to the offset of its latest row."""
+    marker = TOMBSTONE.encode("utf-8")
+    offsets: Dict[int, int] = {}
+    file_handle.seek(start)
+    if start == 0:
+        file_handle.readline()
+    while True:
+        offset = file_handle.tell()
+        line = read_raw_record(file_handle)
+        if not line:
+            return offsets
+        patient_id = line.split(b",", 1)[0]
+        if not patient_id.isdigit():
+            continue
+        if marker in line and parse_record(line)[IDX_NOTES] == TOMBSTONE:
+            offset = -1
+        offsets[int(patient_id)] = offset
+
+
+def merge_offsets(offset_map: OffsetMap, changes: Dict[int, int]) -> None:
+    """Apply ``scan_offsets`` results to an offset map, keeping ids sorted."""
+    ids, offsets = offset_map
+    for patient_id in sorted(changes):
+        offset = changes[patient_id]
+        position = bisect.bisect_left(ids, patient_id)
+        present = position < len(ids) and ids[position] == patient_id
+        if offset < 0:
+            if present:
+                del ids[position]
+                del offsets[position]
+        elif present:
+            offsets[position] = offset
+        else:
+            ids.insert(position, patient_id)
+            offsets.insert(position, offset)
+
+
+def _store_offsets(header: Dict[str, Any], offset_map: OffsetMap) -> None:
+    """Write the offset map as two binary arrays plus a JSON header."""
+    for path, values in zip((IDS_FILE, ROW_OFFSETS_FILE), offset_map):
+        with atomic_open(path, "wb") as file_handle:
+            values.tofile(file_handle)
+    write_sidecar(OFFSETS_FILE, dict(header, rows=len(offset_map[0])))
+
+
+def load_offsets() -> OffsetMap:
+    """Return the live ids and their latest-row offsets, kept in binary sidecars."""
+    ensure_csv()
+    sidecar = load_prefix_sidecar(OFFSETS_FILE)
+    header = sidecar_header()
+    offset_map: OffsetMap = (array("I"), array("Q"))
+    covered = 0
+    if sidecar is not None:
+        try:
+            for path, values in zip((IDS_FILE, ROW_OFFSETS_FILE), offset_map):
+                with open(path, "rb") as file_handle:
+                    values.fromfile(file_handle, sidecar["rows"])
+            covered = sidecar["signature"][1]
+        except (OSError, EOFError):
+            offset_map = (array("I"), array("Q"))
+    with open_journal() as file_handle:
+        merge_offsets(offset_map, scan_offsets(file_handle, covered))
+    if covered == 0 or header["signature"][1] - covered > SIDECAR_MAX_TAIL:
+        _store_offsets(header, offset_map)
+    return offset_map
+
+
+def _iter_chunks(file_handle: BinaryIO, start: int, end: int) -> Iterator[Dict[str, int]]:
+    """Split the journal bytes [start, end) into chunks of up to CHUNK_ROWS rows."""
+    file_handle.seek(start)
+    if start == 0:
+        file_handle.readline()
+    chunk: Dict[str, int] = {}
+    while file_handle.tell() < end:
+        offset = file_handle.tell()
+        line = read_raw_record(file_handle)
+        if not line:
+            break
+        if not chunk:
+            chunk = {"start": offset, "rows": 0, "min_id": -1, "max_id": -1}
+        chunk["rows"] += 1
+        patient_id = line.split(b",", 1)[0]
+        if patient_id.isdigit():
+            value = int(patient_id)
+            chunk["min_id"] = value if chunk["min_id"] < 0 else min(chunk["min_id"], value)
+            chunk["max_id"] = max(chunk["max_id"], value)
+        if chunk["rows"] == CHUNK_ROWS:
+            yield dict(chunk, end=file_handle.tell())
+            chunk = {}
+    if chunk:
+        yield dict(chunk, end=file_handle.tell())
+
+
+def load_zonemap() -> Dict[str, Any]:
+    """Return the journal zonemap: per-chunk byte ranges with min/max ids."""
+    ensure_csv()
+    zonemap = load_prefix_sidecar(ZONEMAP_FILE)
+    header = sidecar_header()
+    size = header["signature"][1]
+    if zonemap is not None and size - zonemap["signature"][1] <= SIDECAR_MAX_TAIL:
+        return zonemap
+    chunks = zonemap["chunks"] if zonemap is not None else []
+    start = zonemap["signature"][1] if zonemap is not None else 0
+    with open_journal() as file_handle:
+        chunks.extend(_iter_chunks(file_handle, start, size))
+    zonemap = dict(header, chunks=chunks)
+    write_sidecar(ZONEMAP_FILE, zonemap)
+    return zonemap
+
+
+def find_latest(patient_id: str) -> Optional[Row]:
+    """Return the latest live version of ``patient_id``, or None."""
+    zonemap = load_zonemap()
+    ranges: List[Tuple[int, Optional[int]]] = [
+        (chunk["start"], chunk["end"])
+        for chunk in zonemap["chunks"]
+        if not patient_id.isdigit() or chunk["min_id"] <= int(patient_id) <= chunk["max_id"]
+    ]
+    ranges.append((zonemap["signature"][1], None))
+    prefix = patient_id.encode("utf-8") + b","
+    latest: Optional[Row] = None
+    with open_journal() as file_handle:
+        for start, end in ranges:
+            file_handle.seek(start)
+            while end is None or file_handle.tell() < end:
+                line = read_raw_record(file_handle)
+                if not line:
+                    break
+                if line.startswith(prefix):
+                    row = parse_record(line)
+                    latest = None if row[IDX_NOTES] == TOMBSTONE else row
+    return latest
+
+
+def _scan_chunk(task: Tuple[str, int, int, bytes]) -> Tuple[int, int, int]:
+    """Total the live rows in journal bytes [start, end) in a worker process."""
+    path, start, end, live_bytes = task
+    live = array("Q")
+    live.frombytes(live_bytes)
+    live_offsets = set(live)
+    rows = age_sum = age_count = 0
+    with open(path, "rb") as file_handle:
+        file_handle.seek(start)
+        while file_handle.tell() < end:
+            offset = file_handle.tell()
+            line = read_raw_record(file_handle)
+            if not line:
+                break
+            if offset not in live_offsets:
+                continue
+            row = parse_record(line)
+            rows += 1
+            if row[IDX_AGE].isdigit():
+                age_sum += int(row[IDX_AGE])
+                age_count += 1
+    return rows, age_sum, age_count
+
+
+def parallel_scan() -> Optional[List[Tuple[int, int, int]]]:
+    """Run ``_scan_chunk`` over the zonemap chunks and tail in parallel, None if not worth it."""
+    if PARALLEL_WORKERS <= 1:
+        return None
+    _ids, offsets = load_offsets()
+    zonemap = load_zonemap()
+    if len(offsets) < PARALLEL_MIN_ROWS or len(zonemap["chunks"]) <= 2:
+        return None
+    live = array("Q", sorted(offsets))
+    ranges = [(chunk["start"], chunk["end"]) for chunk in zonemap["chunks"]]
+    ranges.append((zonemap["signature"][1], csv_signature()[1]))
+    tasks = []
+    for start, end in ranges:
+        low, high = bisect.bisect_left(live, start), bisect.bisect_left(live, end)
+        tasks.append((CSV_FILE, start, end, live[low:high].tobytes()))
+    with ProcessPoolExecutor(max_workers=PARALLEL_WORKERS) as pool:
+        return list(pool.map(_scan_chunk, tasks))
+
+
+def scan_matches(query: str) -> Dict[str, Row]:
+    """Fold the journal into the live rows matching ``query`` (lowercase) by name or phone."""
+    phone_field, needle = phone_needle(query)
+    matches: Dict[str, Row] = {}
+    with open(CSV_FILE, newline="", encoding="utf-8") as file_handle:
+        reader = csv.reader(file_handle)
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            row = upgrade_row(row)
+            if row[IDX_NOTES] != TOMBSTONE and (
+                query in row[IDX_NAME_LOWER] or needle in row[phone_field]
+            ):
+                matches[row[IDX_ID]] = row
+            else:
+                matches.pop(row[IDX_ID], None)
+    return matches
+
+
+def column_path(field: str) -> str:
+    """Return the path of the column file holding ``field``, e.g. patients.age."""
+    return os.path.splitext(CSV_FILE)[0] + "." + field
+
+
+def _write_columnar(rows: List[Row], signature: List[int]) -> None:
+    """Write one column file per field for ``rows``, read from the CSV at ``signature``."""
+    columns = {field: [row[position] for row in rows] for position, field in enumerate(FIELDNAMES)}
+    for field, values in columns.items():
+        with atomic_open(
+            column_path(field), newline="", encoding="utf-8", buffering=WRITE_BUFFER
+        ) as file_handle:
+            writer = csv.writer(file_handle, lineterminator="\n")
+            writer.writerows([value] for value in values)
+    write_sidecar(
+        COLUMNS_FILE,
+        {"signature": signature, "rows": len(rows), "fields": list(columns)},
+    )
+
+
+def columns_fresh(*fields: str) -> bool:
+    """Return whether the column files hold ``fields`` for the current CSV."""
+    if not os.path.exists(CSV_FILE) or not os.path.exists(COLUMNS_FILE):
+        return False
+    try:
+        with open(COLUMNS_FILE, encoding="utf-8") as file_handle:
+            manifest = json.load(file_handle)
+    except ValueError:  # unreadable, so the columns are stale
+        return False
+    return manifest.get("signature") == csv_signature() and set(fields) <= set(manifest.get("fields", []))
+
+
+def age_column_totals() -> Tuple[int, float, int]:
+    """Return (rows, age sum, aged rows) of a fresh age column file, parsed with NumPy."""
+    data = np.fromfile(column_path("age"), dtype=np.uint8)
+    newlines = data == ord("\n")
+    rows = int(np.count_nonzero(newlines))
+    line_of = np.cumsum(newlines) - newlines
+    digits = (data >= ord("0")) & (data <= ord("9"))
+    digit_at = np.flatnonzero(digits)
+    digit_line = line_of[digit_at]
+    others = np.bincount(line_of[~digits & ~newlines], minlength=rows)
+    aged = (others == 0) & (np.bincount(digit_line, minlength=rows) > 0)
+    # Each digit is worth 10 ** (its distance from the end of its line).
+    place = np.flatnonzero(newlines)[digit_line] - digit_at - 1
+    weights = (data[digit_at] - ord("0")) * np.power(10.0, place)
+    values = np.bincount(digit_line, weights=weights, minlength=rows)
+    return rows, float(values[aged].sum()), int(np.count_nonzero(aged))
+
+
+def read_columns(*fields: str, limit: Optional[int] = None) -> Optional[List[List[str]]]:
+    """Read only the requested columns, or None if the column files are stale."""
+    if not columns_fresh(*fields):
+        return None
+    # A negative limit drops rows from the end, as it does in read_first.
+    stop = limit if limit is None or limit >= 0 else None
+    columns = []
+    for field in fields:
+        with open(column_path(field), newline="", encoding="utf-8") as file_handle:
+            reader = itertools.islice(csv.reader(file_handle), stop)
+            columns.append([value for (value,) in reader][:limit])
+    return columns
+
+
+def read_first(limit: int) -> List[Row]:
+    """Read the first ``limit`` live records in id order."""
+    _ids, offsets = load_offsets()
+    rows = []
+    with open(CSV_FILE, "rb") as file_handle:
+        for offset in offsets[:limit]:
+            file_handle.seek(offset)
+            rows.append(read_record(file_handle) or [])
+    return rows
+
+
+def next_id() -> str:
+    """Return the next patient ID from the counter file, seeding it from the journal."""
+    if os.path.exists(ID_FILE):
+        with open(ID_FILE, encoding="utf-8", errors="replace") as file_handle:
+            counter = file_handle.read().strip()
+        if counter.isascii() and counter.isdigit():
+            return counter
+    # Missing or unreadable, so re-seed from the highest id in the journal.
+    highest = 0
+    with open_journal() as file_handle:
+        file_handle.readline()
+        while True:
+            line = read_raw_record(file_handle)
+            if not line:
+                break
+            patient_id = line.split(b",", 1)[0]
+            if patient_id.isdigit():
+                highest = max(highest, int(patient_id))
+    return str(highest + 1)
+
+
+def store_next_id(value: int) -> None:
+    """Atomically replace the counter file with ``value``."""
+    with atomic_open(ID_FILE, encoding="utf-8") as file_handle:
+        file_handle.write(str(value))
 
 
 def add_patient(args: argparse.Namespace) -> None:
     """Add a new patient record."""
-    rows = read_all()
-    patient_id = next_id(rows)
-    now = datetime.utcnow().isoformat()
-    record: Dict[str, str] = {
-        "id": patient_id,
-        "name": args.name.strip(),
-        "age": str(args.age) if args.age else "",
-        "gender": args.gender or "",
-        "phone": args.phone or "",
-        "meds": args.meds or "",
-        "appointments": args.appointments or "",
-        "notes": args.notes or "",
-        "created_at": now,
-        "updated_at": now,
-    }
-    rows.append(record)
-    write_all(rows)
+    with locked_journal() as journal:
+        patient_id = next_id()
+        now = datetime.utcnow().isoformat()
+        name = args.name.strip()
+        phone = args.phone or ""
+        record: Row = [
+            patient_id,
+            name,
+            str(args.age) if args.age else "",
+            args.gender or "",
+            phone,
+            args.meds or "",
+            args.appointments or "",
+            args.notes or "",
+            now,
+            now,
+            name.lower(),
+            digits_only(phone),
+        ]
+        journal.write(format_row(record))
+        store_next_id(int(patient_id) + 1)
     logging.info("ADD id=%s name=%s", patient_id, args.name)
     print(f"Added patient id={patient_id} name={args.name}")
 
 
 def list_patients(args: argparse.Namespace) -> None:
     """List patient records with optional limit."""
-    rows = read_all()
-    rows_sorted = sorted(rows, key=lambda row: int(row["id"]))
     limit = args.limit or 100
-    for row in rows_sorted[:limit]:
+    columns = read_columns("id", "name", "age", "phone", limit=limit)
+    if columns is not None:
+        rows: List[Any] = list(zip(*columns))
+        row_id, row_name, row_age, row_phone = range(4)
+    else:
+        rows = read_first(limit)
+        row_id, row_name, row_age, row_phone = IDX_ID, IDX_NAME, IDX_AGE, IDX_PHONE
+    for row in rows:
         print(
-            f'{row["id"]:>3} | {row["name"][:25]:25} | '
-            f'age:{row["age"] or "-":>3} | phone:{row["phone"] or "-"}'
+            f"{row[row_id]:>3} | {row[row_name][:25]:25} | "
+            f'age:{row[row_age] or "-":>3} | phone:{row[row_phone] or "-"}'
         )
 
 
 def search_patients(args: argparse.Namespace) -> None:
     """Search patients by name or phone."""
     query = (args.name or "").lower()
-    rows = read_all()
-    results = [
-        row
-        for row in rows
-        if query in row["name"].lower() or query in row.get("phone", "")
-    ]
+    phone_field, needle = phone_needle(query)
+    results: List[Tuple[str, str, str, str]] = []
+    with open_journal() as journal:
+        # Current-layout rows hold both needles verbatim, so a raw miss means no match.
+        if not isinstance(journal, mmap.mmap) or (
+            '"' not in query
+            and journal.readline() == format_row(FIELDNAMES)
+            and journal.find(query.encode("utf-8"), journal.tell()) == -1
+            and journal.find(needle.encode("utf-8"), journal.tell()) == -1
+        ):
+            print("No matching patients found.")
+            return
+    columns = read_columns("name_lower", FIELDNAMES[phone_field])
+    if columns is not None:
+        names_lower, phone_values = columns
+        positions = [
+            position
+            for position, (name_lower, phone_value) in enumerate(zip(names_lower, phone_values))
+            if query in name_lower or needle in phone_value
+        ]
+        if positions:
+            ids, names, ages, phones = read_columns("id", "name", "age", "phone") or ([], [], [], [])
+            results = [(ids[pos], names[pos], ages[pos], phones[pos]) for pos in positions]
+    else:
+        matches = scan_matches(query)
+        results = [
+            (row[IDX_ID], row[IDX_NAME], row[IDX_AGE], row[IDX_PHONE])
+            for row in sorted(matches.values(), key=lambda row: int(row[IDX_ID]))
+        ]
     if not results:
         print("No matching patients found.")
         return
-    for row in results:
-        print(f'[{row["id"]}] {row["name"]} | age:{row["age"]} | phone:{row["phone"]}')
+    print(
+        "\n".join(
+            f"[{patient_id}] {name} | age:{age} | phone:{phone}"
+            for patient_id, name, age, phone in results
+        )
+    )
+
+
+def match_batch(queries: List[str], haystacks: List[str]) -> List[List[int]]:
+    """Return, for each query, the positions of the haystacks containing it."""
+    hits: List[Set[int]] = [set() for _ in queries]
+    if hyperscan is not None:
+        data = "\x00".join(haystacks).encode("utf-8")
+        ends = list(itertools.accumulate(len(h.encode("utf-8")) + 1 for h in haystacks))
+        database = hyperscan.Database()
+        database.compile(
+            expressions=[re.escape(query).encode("utf-8") for query in queries],
+            ids=list(range(len(queries))),
+            elements=len(queries),
+            flags=0,
+        )
+
+        def on_match(query_id: int, _start: int, end: int, _flags: int, _context: Any) -> None:
+            hits[query_id].add(bisect.bisect_left(ends, end))
+
+        database.scan(data, match_event_handler=on_match)
+    else:
+        prefilter = re.compile("|".join(re.escape(query) for query in queries))
+        for position, haystack in enumerate(haystacks):
+            if prefilter.search(haystack):
+                for query_id, query in enumerate(queries):
+                    if query in haystack:
+                        hits[query_id].add(position)
+    return [sorted(positions) for positions in hits]
+
+
+def search_batch(args: argparse.Namespace) -> None:
+    """Run every query of a file (one per line) against names and phones."""
+    with open(args.file, encoding="utf-8") as file_handle:
+        queries = [line.rstrip("\r\n").lower() for line in file_handle if line.strip()]
+    columns = read_columns("id", "name", "age", "phone", "name_lower", "phone_digits")
+    if columns is not None:
+        rows: List[Any] = list(zip(*columns))
+    else:
+        rows = [
+            (
+                row[IDX_ID],
+                row[IDX_NAME],
+                row[IDX_AGE],
+                row[IDX_PHONE],
+                row[IDX_NAME_LOWER],
+                row[IDX_PHONE_DIGITS],
+            )
+            for row in read_all()
+        ]
+    haystacks = [f"{name_lower}\n{phone}" for *_fields, phone, name_lower, _digits in rows]
+    hits = match_batch(queries, haystacks) if queries else []
+    # Phone-like queries also match on digits, in a second pass over phone_digits.
+    digit_queries = [
+        (query_id, needle)
+        for query_id, (phone_field, needle) in enumerate(map(phone_needle, queries))
+        if phone_field == IDX_PHONE_DIGITS
+    ]
+    if digit_queries:
+        digit_hits = match_batch([needle for _query_id, needle in digit_queries], [row[-1] for row in rows])
+        for (query_id, _needle), positions in zip(digit_queries, digit_hits):
+            hits[query_id] = sorted(set(hits[query_id]).union(positions))
+    for query, positions in zip(queries, hits):
+        print(f"== {query}")
+        if not positions:
+            print("No matching patients found.")
+        for position in positions:
+            patient_id, name, age, phone, _name_lower, _digits = rows[position]
+            print(f"[{patient_id}] {name} | age:{age} | phone:{phone}")
+
+
+def _update_mask(args: argparse.Namespace) -> int:
+    """Return the bitmask of ``_UPDATE_FIELDS`` entries given on the command line."""
+    mask = 0
+    for bit, (field, _index, set_if_not_none) in enumerate(_UPDATE_FIELDS):
+        value = getattr(args, field)
+        if (value is not None) if set_if_not_none else value:
+            mask |= 1 << bit
+    return mask
+
+
+def _compile_updater(mask: int) -> Callable[[Row, argparse.Namespace, str], None]:
+    """Generate a function that assigns exactly the fields selected by ``mask``."""
+    lines = ["def updater(row, args, now):"]
+    for bit, (field, index, _set_if_not_none) in enumerate(_UPDATE_FIELDS):
+        if mask & (1 << bit):
+            value = f"str(args.{field})" if field == "age" else f"args.{field}"
+            lines.append(f"    row[{index}] = {value}")
+            if index == IDX_NAME:
+                lines.append(f"    row[{IDX_NAME_LOWER}] = row[{IDX_NAME}].lower()")
+            elif index == IDX_PHONE:
+                lines.append(f"    row[{IDX_PHONE_DIGITS}] = digits_only(row[{IDX_PHONE}])")
+    lines.append(f"    row[{IDX_UPDATED_AT}] = now")
+    namespace: Dict[str, Any] = {"digits_only": digits_only}
+    exec(compile("\n".join(lines), f"<updater {mask:#x}>", "exec"), namespace)  # pylint: disable=exec-used
+    return namespace["updater"]
 
 
 def update_patient(args: argparse.Namespace) -> None:
     """Update patient record by ID."""
-    rows = read_all()
-    updated = False
-    for row in rows:
-        if row["id"] == str(args.id):
-            if args.name:
-                row["name"] = args.name
-            if args.age is not None:
-                row["age"] = str(args.age)
-            if args.gender:
-                row["gender"] = args.gender
-            if args.phone:
-                row["phone"] = args.phone
-            if args.meds is not None:
-                row["meds"] = args.meds
-            if args.appointments is not None:
-                row["appointments"] = args.appointments
-            if args.notes is not None:
-                row["notes"] = args.notes
-            row["updated_at"] = datetime.utcnow().isoformat()
-            updated = True
-            logging.info("UPDATE id=%s", row["id"])
-            print("Updated:", row["id"], row["name"])
-            break
-    if not updated:
-        print("Patient id not found:", args.id)
-    else:
-        write_all(rows)
+    with locked_journal() as journal:
+        row = find_latest(str(args.id))
+        if row is None:
+            print("Patient id not found:", args.id)
+            return
+        mask = _update_mask(args)
+        updater = _UPDATERS.get(mask)
+        if updater is None:
+            updater = _UPDATERS[mask] = _compile_updater(mask)
+        updater(row, args, datetime.utcnow().isoformat())
+        journal.write(format_row(row))
+    logging.info("UPDATE id=%s", row[IDX_ID])
+    print("Updated:", row[IDX_ID], row[IDX_NAME])
 
 
 def delete_patient(args: argparse.Namespace) -> None:
     """Delete patient record by ID."""
+    with locked_journal() as journal:
+        if find_latest(str(args.id)) is None:
+            print("Patient id not found:", args.id)
+            return
+        tombstone: Row = [""] * len(FIELDNAMES)
+        tombstone[IDX_ID] = str(args.id)
+        tombstone[IDX_NOTES] = TOMBSTONE
+        tombstone[IDX_UPDATED_AT] = datetime.utcnow().isoformat()
+        journal.write(format_row(tombstone))
+    logging.info("DELETE id=%s", args.id)
+    print("Deleted patient id:", args.id)
+
+
+def compact(args: argparse.Namespace) -> None:
+    """Rewrite the CSV journal keeping only the latest live records."""
+    with locked_journal():
+        latest, physical = read_journal()
+        stale = physical - len(latest)
+        if stale < args.threshold:
+            print(f"Nothing to compact ({stale} stale rows, threshold {args.threshold}).")
+            return
+        write_all(list(latest.values()))
+    logging.info("COMPACT removed=%s", stale)
+    print("Compacted journal, removed stale rows:", stale)
+
+
+def columnize(_args: argparse.Namespace) -> None:
+    """Write the per-column files used by scans in list, search and stats."""
+    # Taken before reading, so rows appended meanwhile leave the snapshot stale.
+    signature = csv_signature()
     rows = read_all()
-    new_rows = [row for row in rows if row["id"] != str(args.id)]
-    if len(new_rows) == len(rows):
-        print("Patient id not found:", args.id)
-    else:
-        write_all(new_rows)
-        logging.info("DELETE id=%s", args.id)
-        print("Deleted patient id:", args.id)
+    _write_columnar(rows, signature)
+    print("Wrote column files for patients:", len(rows))
+
+
+def dump_json(record: Dict[str, str], pretty: bool) -> bytes:
+    """Serialise one record to UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(record, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
 def export_data(args: argparse.Namespace) -> None:
     """Export patient records to JSON."""
-    rows = read_all()
+    _ids, offsets = load_offsets()
     output_file = args.out or "exported_patients.json"
-    with open(output_file, "w", encoding="utf-8") as file_handle:
-        json.dump(rows, file_handle, indent=2)
+    if args.pretty:
+        opening, separator, closing = b"[\n  ", b",\n  ", b"\n]\n"
+    else:
+        opening, separator, closing = b"[", b",", b"]\n"
+    with open(CSV_FILE, "rb") as in_handle, open(
+        output_file, "wb", buffering=WRITE_BUFFER
+    ) as out_handle:
+        if not offsets:
+            out_handle.write(b"[]\n")
+        first = True
+        for offset in offsets:
+            in_handle.seek(offset)
+            record = dict(zip(FIELDNAMES[:LEGACY_FIELD_COUNT], read_record(in_handle) or []))
+            out_handle.write(opening if first else separator)
+            body = dump_json(record, args.pretty)
+            out_handle.write(body.replace(b"\n", b"\n  ") if args.pretty else body)
+            first = False
+        if offsets:
+            out_handle.write(closing)
     print("Exported to", output_file)
 
 
 def stats(_args: argparse.Namespace) -> None:
     """Show basic statistics of patients."""
-    rows = read_all()
-    total = len(rows)
-    ages = [int(row["age"]) for row in rows if row["age"].isdigit()]
-    avg_age: Optional[float] = sum(ages) / len(ages) if ages else None
+    if np is not None and columns_fresh("age"):
+        totals = [age_column_totals()]
+    else:
+        columns = read_columns("age")
+        totals = parallel_scan() if columns is None else None
+        if totals is None:
+            age_values = columns[0] if columns is not None else [row[IDX_AGE] for row in read_all()]
+            ages = [int(age) for age in age_values if age.isdigit()]
+            totals = [(len(age_values), sum(ages), len(ages))]
+    total, age_sum, age_count = (sum(values) for values in zip(*totals))
+    avg_age = age_sum / age_count if age_count else None
     print("Total patients:", total)
     print("Avg age:", f"{avg_age:.1f}" if avg_age is not None else "-")
 
 
+def notes_text(value: str) -> str:
+    """Argparse type for ``--notes``: anything but the deletion sentinel."""
+    if value == TOMBSTONE:
+        raise argparse.ArgumentTypeError(f"{TOMBSTONE!r} is reserved for deleted records")
+    return value
+
+
 def parse_args(argv=None) -> argparse.Namespace:
     """Parse CLI arguments."""
     parser = argparse.ArgumentParser(prog="emr_cli", description="Lightweight EMR CLI")
@@ -187,7 +933,7 @@ def parse_args(argv=None) -> argparse.Namespace:
     parser_add.add_argument("--phone")
     parser_add.add_argument("--meds", default="")
     parser_add.add_argument("--appointments", default="")
-    parser_add.add_argument("--notes", default="")
+    parser_add.add_argument("--notes", type=notes_text, default="")
     parser_add.set_defaults(func=add_patient)
 
     parser_list = subparsers.add_parser("list", help="List patients")
@@ -200,6 +946,12 @@ def parse_args(argv=None) -> argparse.Namespace:
     parser_search.add_argument("--name", required=True)
     parser_search.set_defaults(func=search_patients)
 
+    parser_search_batch = subparsers.add_parser(
+        "search-batch", help="Run many name/phone searches in one pass"
+    )
+    parser_search_batch.add_argument("--file", required=True, help="File with one query per line")
+    parser_search_batch.set_defaults(func=search_batch)
+
     parser_update = subparsers.add_parser("update", help="Update patient fields by id")
     parser_update.add_argument("--id", required=True)
     parser_update.add_argument("--name")
@@ -208,7 +960,7 @@ def parse_args(argv=None) -> argparse.Namespace:
     parser_update.add_argument("--phone")
     parser_update.add_argument("--meds")
     parser_update.add_argument("--appointments")
-    parser_update.add_argument("--notes")
+    parser_update.add_argument("--notes", type=notes_text)
     parser_update.set_defaults(func=update_patient)
 
     parser_delete = subparsers.add_parser("delete", help="Delete patient by id")
@@ -217,11 +969,28 @@ def parse_args(argv=None) -> argparse.Namespace:
 
     parser_export = subparsers.add_parser("export", help="Export data to JSON")
     parser_export.add_argument("--out", help="Output filename")
+    parser_export.add_argument("--pretty", action="store_true", help="Indent the JSON output")
     parser_export.set_defaults(func=export_data)
 
     parser_stats = subparsers.add_parser("stats", help="Show basic stats")
     parser_stats.set_defaults(func=stats)
 
+    parser_compact = subparsers.add_parser(
+        "compact", help="Drop superseded and deleted rows from the CSV"
+    )
+    parser_compact.add_argument(
+        "--threshold",
+        type=int,
+        default=COMPACT_THRESHOLD,
+        help="Minimum number of stale rows before rewriting",
+    )
+    parser_compact.set_defaults(func=compact)
+
+    parser_columnize = subparsers.add_parser(
+        "columnize", help="Write per-column files for faster scans"
+    )
+    parser_columnize.set_defaults(func=columnize)
+
     return parser.parse_args(argv)
 
 
@@ -1,7 +1,10 @@
 """Smoke tests for EMR CLI."""
 
+import json
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 import subprocess
 
@@ -12,16 +15,267 @@ EMR_PATH = os.path.join(BASE_DIR, "emr_cli.py")
 class SmokeTest(unittest.TestCase):
     """Basic smoke tests for the EMR CLI."""
 
-    def test_list_patients(self):
-        """Test 'list' command returns expected output."""
+    def setUp(self):
+        """Copy the CLI into a temporary directory so it gets its own CSV."""
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.work_dir = work_dir.name
+        self.emr_path = shutil.copy(EMR_PATH, self.work_dir)
+        self.run_cli("add", "--name", "Asha Kumari", "--age", "34", "--phone", "9876543210")
+
+    def run_cli(self, *args):
+        """Run the copied CLI with ``args`` and return its stdout."""
+        process = subprocess.run(
+            [sys.executable, self.emr_path, *args],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        return process.stdout
+
+    def run_python(self, code):
+        """Run ``code`` against the copied module and return its stdout."""
         process = subprocess.run(
-            [sys.executable, EMR_PATH, "list", "--limit", "5"],
+            [sys.executable, "-c", "import emr_cli\n" + code],
             capture_output=True,
             check=True,
+            cwd=self.work_dir,
             text=True,
         )
-        self.assertEqual(process.returncode, 0)
-        self.assertIn("Asha Kumari", process.stdout)
+        return process.stdout
+
+    def run_patched(self, patches, *argvs):
+        """Run each CLI argument list in one process, with module constants set from ``patches``."""
+        code = "".join(f"emr_cli.{name} = {value!r}\n" for name, value in patches.items())
+        code += "".join(f"emr_cli.main({list(argv)!r})\n" for argv in argvs)
+        return self.run_python(code)
+
+    def test_list_patients(self):
+        """Test 'list' command returns expected output."""
+        self.assertIn("Asha Kumari", self.run_cli("list", "--limit", "5"))
+
+    def test_list_negative_limit(self):
+        """Test 'list --limit -1' leaves out the last patient, with and without column files."""
+        self.run_cli("add", "--name", "Ravi Teja")
+        self.run_cli("add", "--name", "Meena Rao")
+        for columnize in (False, True):
+            if columnize:
+                self.run_cli("columnize")
+            listing = self.run_cli("list", "--limit", "-1")
+            self.assertIn("Ravi Teja", listing)
+            self.assertNotIn("Meena Rao", listing)
+
+    def test_update_delete_compact(self):
+        """Test updates and deletes fold correctly before and after 'compact'."""
+        self.run_cli("add", "--name", "Ravi Teja", "--phone", "9000000001")
+        self.run_cli("add", "--name", "Meena Rao", "--age", "40")
+        self.run_cli("update", "--id", "1", "--name", "Asha Rao")
+        self.run_cli("delete", "--id", "2")
+        # Build the offset sidecars over the journal.
+        self.assertIn("[3] Meena Rao", self.run_cli("search", "--name", "rao"))
+        listing = self.run_cli("list")
+        self.assertIn("Asha Rao", listing)
+        self.assertNotIn("Asha Kumari", listing)
+        self.assertNotIn("Ravi Teja", listing)
+
+        self.assertIn("removed stale rows: 3", self.run_cli("compact", "--threshold", "0"))
+        self.run_cli("update", "--id", "3", "--age", "41")
+        self.assertIn("Patient id not found: 2", self.run_cli("update", "--id", "2", "--age", "1"))
+        self.assertIn("id=4", self.run_cli("add", "--name", "Kai"))
+        search = self.run_cli("search", "--name", "rao")
+        self.assertIn("[1] Asha Rao | age:34", search)
+        self.assertIn("[3] Meena Rao | age:41", search)
+        self.assertNotIn("Ravi", self.run_cli("search", "--name", "9000000001"))
+        self.assertIn("Total patients: 3\nAvg age: 37.5", self.run_cli("stats"))
+
+    def test_next_id_reseeded(self):
+        """Test an empty or garbled id counter file is re-seeded from the journal."""
+        counter = os.path.join(self.work_dir, "patients.csv.nextid")
+        for content, expected in ((b"", "id=2"), (b"\xff7x", "id=3")):
+            with open(counter, "wb") as file_handle:
+                file_handle.write(content)
+            self.assertIn(expected, self.run_cli("add", "--name", "Ravi Teja"))
+
+    def test_blank_journal_line(self):
+        """Test a blank line in the journal is skipped rather than read as a record."""
+        self.run_cli("add", "--name", "Ravi Teja", "--age", "40")
+        with open(os.path.join(self.work_dir, "patients.csv"), "ab") as file_handle:
+            file_handle.write(b"\r\n")
+        self.run_cli("add", "--name", "Meena Rao")
+        self.assertIn("Total patients: 3\nAvg age: 37.0", self.run_cli("stats"))
+        self.assertIn("[3] Meena Rao", self.run_cli("search", "--name", "meena"))
+        self.run_cli("update", "--id", "2", "--age", "41")
+        self.assertIn("Ravi Teja", self.run_cli("list"))
+        self.assertIn("removed stale rows: 1", self.run_cli("compact", "--threshold", "0"))
+        self.assertIn("Total patients: 3\nAvg age: 37.5", self.run_cli("stats"))
+
+    def test_stats_age_column(self):
+        """Test 'stats' skips empty and negative ages, with and without column files."""
+        self.run_cli("add", "--name", "Ravi Teja", "--age", "120")
+        self.run_cli("add", "--name", "Meena Rao")
+        self.run_cli("add", "--name", "Kai", "--age", "-3")
+        expected = "Total patients: 4\nAvg age: 77.0"
+        self.assertIn(expected, self.run_cli("stats"))
+        self.run_cli("columnize")
+        self.assertIn(expected, self.run_cli("stats"))
+
+    def test_parallel_stats_scan(self):
+        """Test the parallel stats scan totals only live rows, chunk by chunk."""
+        for age in ("20", "30", "40", "50", "60"):
+            self.run_cli("add", "--name", "Patient " + age, "--age", age)
+        self.run_cli("update", "--id", "2", "--age", "21")
+        self.run_cli("delete", "--id", "6")
+        # Rebuild the zonemap with two-row chunks.
+        os.remove(os.path.join(self.work_dir, "patients.csv.zonemap.json"))
+        code = (
+            "emr_cli.CHUNK_ROWS = 2\n"
+            "emr_cli.PARALLEL_MIN_ROWS = 1\n"
+            "emr_cli.PARALLEL_WORKERS = 2\n"
+            "totals = emr_cli.parallel_scan()\n"
+            "print(len(totals), [sum(values) for values in zip(*totals)])\n"
+            "emr_cli.PARALLEL_WORKERS = 1\n"
+            "print(emr_cli.parallel_scan())\n"
+        )
+        self.assertEqual(self.run_python(code), "5 [5, 175, 5]\nNone\n")
+
+    def test_sidecars_past_thresholds(self):
+        """Test offset and zonemap sidecars stay right as appends outgrow them."""
+        patches = {"SIDECAR_MAX_TAIL": 200, "CHUNK_ROWS": 2}
+        self.run_patched(
+            patches, *(["add", "--name", f"Patient {number}"] for number in range(2, 9))
+        )
+        self.run_patched(patches, ["list"])
+        # Appends soon outgrow SIDECAR_MAX_TAIL, so later steps extend the sidecars.
+        updated = self.run_patched(patches, ["update", "--id", "7", "--age", "70"])
+        self.assertIn("Updated: 7", updated)
+        self.run_patched(patches, ["delete", "--id", "2"], ["add", "--name", "Patient 9"])
+        self.run_patched(patches, ["list"])
+        for patient_id in ("3", "4", "9"):
+            self.run_patched(patches, ["update", "--id", patient_id, "--meds", "x" * 40])
+        missing = self.run_patched(patches, ["update", "--id", "2", "--age", "1"])
+        self.assertIn("Patient id not found: 2", missing)
+        live_ids = ["1", "3", "4", "5", "6", "7", "8", "9"]
+        listing = self.run_patched(patches, ["list"])
+        self.assertEqual([line.split("|")[0].strip() for line in listing.splitlines()], live_ids)
+        self.assertIn("Patient 7                 | age: 70", listing)
+        self.assertIn("[9] Patient 9", self.run_patched(patches, ["search", "--name", "patient 9"]))
+
+        zonemap_path = os.path.join(self.work_dir, "patients.csv.zonemap.json")
+        with open(zonemap_path, encoding="utf-8") as file_handle:
+            chunks = json.load(file_handle)["chunks"]
+        self.assertGreater(len(chunks), 4)
+        self.assertTrue(all(chunk["rows"] <= 2 for chunk in chunks))
+        for left, right in zip(chunks, chunks[1:]):
+            self.assertEqual(left["end"], right["start"])
+
+        out_path = os.path.join(self.work_dir, "export.json")
+        self.run_cli("export", "--out", out_path, "--pretty")
+        with open(out_path, encoding="utf-8") as file_handle:
+            text = file_handle.read()
+        self.assertTrue(text.startswith('[\n  {\n    "id": "1",'))
+        records = json.loads(text)
+        self.assertEqual([record["id"] for record in records], live_ids)
+        self.assertEqual(records[1]["meds"], "x" * 40)
+
+    def test_legacy_journal(self):
+        """Test a journal without name_lower and phone_digits is read and upgraded by 'compact'."""
+        for name in os.listdir(self.work_dir):
+            if name.startswith("patients."):
+                os.remove(os.path.join(self.work_dir, name))
+        csv_path = os.path.join(self.work_dir, "patients.csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as file_handle:
+            file_handle.write(
+                "id,name,age,gender,phone,meds,appointments,notes,created_at,updated_at\r\n"
+                "1,Asha Kumari,34,F,(987) 654-3210,,,,t,t\r\n"
+                "2,Ravi Teja,40,M,9000000001,,,,t,t\r\n"
+            )
+        self.assertIn("[1] Asha Kumari", self.run_cli("search", "--name", "987654"))
+        self.assertIn("[2] Ravi Teja", self.run_cli("search", "--name", "ravi"))
+        self.run_cli("update", "--id", "2", "--age", "41")
+        self.assertIn("id=3", self.run_cli("add", "--name", "Meena Rao"))
+        self.assertIn("removed stale rows: 1", self.run_cli("compact", "--threshold", "0"))
+        with open(csv_path, encoding="utf-8") as file_handle:
+            self.assertEqual(
+                file_handle.readline().strip(),
+                "id,name,age,gender,phone,meds,appointments,notes,created_at,updated_at,"
+                "name_lower,phone_digits",
+            )
+        self.assertIn("[1] Asha Kumari", self.run_cli("search", "--name", "987-654"))
+        out_path = os.path.join(self.work_dir, "export.json")
+        self.run_cli("export", "--out", out_path)
+        with open(out_path, encoding="utf-8") as file_handle:
+            records = json.load(file_handle)
+        self.assertEqual(len(records[0]), 10)
+        self.assertEqual(records[1]["age"], "41")
+
+    def test_notes_tombstone_rejected(self):
+        """Test the deletion sentinel cannot be stored as a patient's notes."""
+        for args in (("add", "--name", "Ravi"), ("update", "--id", "1")):
+            process = subprocess.run(
+                [sys.executable, self.emr_path, *args, "--notes", "__tombstone__"],
+                capture_output=True,
+                check=False,
+                text=True,
+            )
+            self.assertNotEqual(process.returncode, 0)
+            self.assertIn("reserved for deleted records", process.stderr)
+        self.assertIn("Asha Kumari", self.run_cli("list"))
+
+    def test_torn_sidecars_rebuilt(self):
+        """Test unreadable sidecar files are treated as stale and rebuilt."""
+        self.run_cli("columnize")
+        for suffix in (".offsets", ".zonemap.json", ".columns.json"):
+            sidecar = os.path.join(self.work_dir, "patients.csv" + suffix)
+            with open(sidecar, "w", encoding="utf-8") as file_handle:
+                file_handle.write('{"signature": [1, ')
+        self.run_cli("update", "--id", "1", "--age", "35")
+        self.assertIn("Asha Kumari", self.run_cli("list"))
+        self.assertIn("Total patients: 1\nAvg age: 35.0", self.run_cli("stats"))
+
+    def test_export_fields(self):
+        """Test 'export' writes only the patient fields, not the derived search fields."""
+        out_path = os.path.join(self.work_dir, "export.json")
+        self.run_cli("export", "--out", out_path)
+        with open(out_path, encoding="utf-8") as file_handle:
+            records = json.load(file_handle)
+        self.assertEqual(records[0]["name"], "Asha Kumari")
+        self.assertNotIn("name_lower", records[0])
+        self.assertNotIn("phone_digits", records[0])
+
+    def test_search_phone_digits(self):
+        """Test 'search' matches phones on digits, ignoring separators."""
+        self.assertIn("Asha Kumari", self.run_cli("search", "--name", "987-654"))
+
+    def test_search_name_with_digits(self):
+        """Test a name query containing digits is not matched against phone digits."""
+        self.run_cli("add", "--name", "Zoe Person111", "--phone", "9123146761")
+        self.assertIn("Zoe Person111", self.run_cli("search", "--name", "person111"))
+        self.assertIn("No matching patients found.", self.run_cli("search", "--name", "person123"))
+        self.assertIn("No matching patients found.", self.run_cli("search", "--name", "zoe person12"))
+        self.run_cli("columnize")
+        self.assertIn("No matching patients found.", self.run_cli("search", "--name", "person123"))
+        self.assertIn("Zoe Person111", self.run_cli("search", "--name", "(912) 314"))
+
+    def test_search_batch(self):
+        """Test 'search-batch' reports matches for each query in the file."""
+        queries = os.path.join(self.work_dir, "queries.txt")
+        with open(queries, "w", encoding="utf-8") as file_handle:
+            file_handle.write("asha\nzzz-no-such-patient\n")
+        output = self.run_cli("search-batch", "--file", queries)
+        self.assertIn("== asha", output)
+        self.assertIn("Asha Kumari", output)
+        self.assertIn("== zzz-no-such-patient\nNo matching patients found.", output)
+
+    def test_search_batch_phone_digits(self):
+        """Test 'search-batch' matches phone-like queries on digits, like 'search'."""
+        self.run_cli("add", "--name", "Ravi Teja", "--phone", "(555) 111")
+        queries = os.path.join(self.work_dir, "queries.txt")
+        with open(queries, "w", encoding="utf-8") as file_handle:
+            file_handle.write("555111\n555-111\nteja555\n")
+        output = self.run_cli("search-batch", "--file", queries)
+        self.assertIn("== 555111\n[2] Ravi Teja", output)
+        self.assertIn("== 555-111\n[2] Ravi Teja", output)
+        self.assertIn("== teja555\nNo matching patients found.", output)
 
 
 if __name__ == "__main__":